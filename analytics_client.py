@@ -0,0 +1,239 @@
+"""
+Team Flex Credits - Analytics API Client
+Shared session, worker pool and request helpers used by the report scripts.
+"""
+
+import time
+import statistics
+import gzip
+import json
+import requests
+from collections import Counter
+from functools import lru_cache
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+API_URL = "https://server.codeium.com/api/v1/Analytics"
+
+# Warm-up round trips faster than this (seconds) let fetch_parallel use every worker
+FAST_LATENCY_SECONDS = 0.3
+
+# Shared session so worker threads reuse keep-alive connections instead of
+# paying a TCP+TLS handshake per API key
+SESSION = requests.Session()
+SESSION.headers.update({"Content-Type": "application/json"})
+
+# 429/5xx answers are retried with backoff, for every request on the session
+# (including the email mapping one); other errors fail straight away
+RETRY_POLICY = Retry(total=5, backoff_factor=0.3,
+                     status_forcelist=[429, 500, 502, 503, 504],
+                     allowed_methods=["POST"])
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=DEFAULT_POOLSIZE, pool_block=True,
+                                      max_retries=RETRY_POLICY))
+
+# Keep-alive sockets the mounted adapter may hold; size_connection_pool only grows it
+connection_limit = DEFAULT_POOLSIZE
+
+# Whether request bodies are gzip-compressed; None until check_gzip_support()
+# has a conclusive answer from the API, and sent plain until then
+gzip_requests = None
+
+# Worker threads and pooled connections are created once and reused by later
+# fetch_parallel calls (e.g. when the scripts are imported as a library)
+executor = None
+pool_size = 0
+
+
+def dumps_json(obj, indent=False):
+    """Serialize obj to JSON bytes, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    if indent:
+        return json.dumps(obj, indent=2).encode("utf-8")
+    # Compact separators, matching orjson's output size
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def loads_json(data):
+    """Parse JSON bytes or str, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+@lru_cache(maxsize=8)
+def payload_template(create_payload, start_date, end_date):
+    """Pre-serialize a script's payload for a date range around its API key slots
+    
+    Returns (head, query_head, query_tail, tail) so that a batch body is
+    head + "[" + query_head + <key> + query_tail + ... + "]" + tail.
+    """
+    key_slot = dumps_json("__API_KEY__")
+    queries_slot = dumps_json("__QUERY_REQUESTS__")
+    
+    payload = create_payload(["__API_KEY__"], start_date, end_date)
+    query_head, query_tail = dumps_json(payload["query_requests"][0]).split(key_slot)
+    payload["query_requests"] = "__QUERY_REQUESTS__"
+    head, tail = dumps_json(payload).split(queries_slot)
+    return head, query_head, query_tail, tail
+
+
+def build_payload_body(create_payload, api_keys, start_date, end_date):
+    """Serialize the request body for a batch of API keys from the cached template"""
+    head, query_head, query_tail, tail = payload_template(create_payload, start_date, end_date)
+    queries = b",".join(query_head + dumps_json(api_key) + query_tail for api_key in api_keys)
+    return head + b"[" + queries + b"]" + tail
+
+
+def size_connection_pool(connections):
+    """Let the shared session keep at least `connections` keep-alive sockets
+    
+    The pool only grows. The replaced adapter is closed so its sockets are
+    released instead of leaked.
+    """
+    global connection_limit
+    if connections <= connection_limit:
+        return
+    
+    # One keep-alive socket per worker; pool_block makes any extra request wait
+    # for a pooled connection instead of opening a throwaway one
+    previous = SESSION.adapters["https://"]
+    SESSION.mount("https://", HTTPAdapter(
+        pool_connections=connections,
+        pool_maxsize=connections,
+        pool_block=True,
+        max_retries=RETRY_POLICY
+    ))
+    previous.close()
+    connection_limit = connections
+
+
+def configure_session(max_workers):
+    """Size the shared connection pool and worker threads for max_workers"""
+    global executor, pool_size
+    size_connection_pool(max_workers)
+    if executor is not None and pool_size == max_workers:
+        return
+    
+    if executor is not None:
+        executor.shutdown(wait=False)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pool_size = max_workers
+
+
+def warmup(connections):
+    """Open keep-alive connections with cheap HEAD requests before the real batch
+    
+    Returns the median round-trip time in seconds on the opened connections,
+    or None if every request failed.
+    """
+    def ping(_):
+        try:
+            # The first HEAD pays for the TCP+TLS setup; time a second one on
+            # the now-open connection so only the round trip is measured
+            SESSION.head(API_URL, timeout=5)
+            started = time.perf_counter()
+            SESSION.head(API_URL, timeout=5)
+        except requests.RequestException:
+            return None
+        return time.perf_counter() - started
+    
+    latencies = [latency for latency in executor.map(ping, range(connections)) if latency is not None]
+    return statistics.median(latencies) if latencies else None
+
+
+def size_workers(max_workers, batch_count):
+    """Pick the worker count for batch_count requests and warm up its connections
+    
+    Starts with half the workers and only grows to the full count when the
+    warm-up requests come back quickly, so a slow API isn't hit with the whole
+    pool at once. Returns the number of workers in use.
+    """
+    # Never keep more threads and sockets than there are batches in flight
+    workers = max(1, min(max_workers, batch_count))
+    probe_workers = max(1, workers // 2)
+    if executor is not None and pool_size in (probe_workers, workers):
+        return pool_size
+    
+    # The connection pool is sized for the full count up front, so growing
+    # only adds threads and the probe's warm sockets are kept
+    size_connection_pool(workers)
+    configure_session(probe_workers)
+    latency = warmup(probe_workers)
+    if workers > probe_workers and latency is not None and latency < FAST_LATENCY_SECONDS:
+        configure_session(workers)
+        warmup(workers)
+    
+    return pool_size
+
+
+def probe_accepts(body, headers):
+    """POST body once and close the response unread
+    
+    Returns whether the API answered 2xx, or None if the request failed
+    (including 429/5xx that were still failing after the session's retries).
+    """
+    try:
+        response = SESSION.post(API_URL, data=body, headers=headers, timeout=10, stream=True)
+    except requests.RequestException:
+        return None
+    response.close()
+    return response.ok
+
+
+def check_gzip_support(body):
+    """Decide once whether the API accepts gzip-compressed request bodies
+    
+    body should be a single-key query so the probe is cheap and can't be
+    refused for carrying too many queries. Gzip is only turned off when the
+    server refuses the compressed body but accepts the same body plain; an
+    inconclusive probe leaves the decision open and bodies plain.
+    """
+    global gzip_requests
+    if gzip_requests is not None:
+        return
+    
+    accepted = probe_accepts(gzip.compress(body, compresslevel=6), {"Content-Encoding": "gzip"})
+    if accepted:
+        gzip_requests = True
+    elif accepted is not None and probe_accepts(body, {}):
+        gzip_requests = False
+
+
+def post_analytics(body, **kwargs):
+    """POST a JSON body to the Analytics API, gzip-compressed if the server accepts it"""
+    if gzip_requests:
+        return SESSION.post(API_URL, data=gzip.compress(body, compresslevel=6),
+                            headers={"Content-Encoding": "gzip"}, timeout=10, **kwargs)
+    return SESSION.post(API_URL, data=body, timeout=10, **kwargs)
+
+
+def batch_rejected(api_keys, error):
+    """Whether a multi-key request got a 4xx that may only mean the server
+    refuses that many queries in one body, so asking per key can still work"""
+    if len(api_keys) < 2 or not isinstance(error, requests.HTTPError) or error.response is None:
+        return False
+    
+    # Auth and rate-limit answers aren't about the body; per-key requests
+    # would fail the same way
+    status = error.response.status_code
+    return 400 <= status < 500 and status not in (401, 403, 429)
+
+
+def report_failures(failures):
+    """Print the requests that still failed after retries, grouped by error"""
+    failed_users = sum(len(api_keys) for api_keys, _ in failures)
+    print(f"⚠️  {len(failures)} request(s) failed for {failed_users} users; their credits are missing from this report:")
+    
+    errors = Counter(f"{type(error).__name__}: {error}" for _, error in failures)
+    for message, count in errors.most_common(5):
+        print(f"   - {count}x {message}")
+    if len(errors) > 5:
+        print(f"   - ... and {len(errors) - 5} other error(s)")
+    print()
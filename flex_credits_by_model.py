@@ -5,16 +5,43 @@ Fast parallel processing showing flex credits usage per model per day.
 """
 
 import os
-import json
+import calendar
+import re
+import sys
 import requests
+import urllib3
 import csv
 import argparse
+import operator
 from datetime import datetime, timedelta
 from collections import defaultdict
+from functools import lru_cache
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 
+# HTTP session, worker pool and request helpers shared by the report scripts
+try:
+    from . import analytics_client
+    from .analytics_client import (SESSION, dumps_json, loads_json, build_payload_body, size_connection_pool,
+                                   size_workers, check_gzip_support, post_analytics,
+                                   batch_rejected, report_failures)
+except ImportError:
+    import analytics_client
+    from analytics_client import (SESSION, dumps_json, loads_json, build_payload_body, size_connection_pool,
+                                  size_workers, check_gzip_support, post_analytics,
+                                  batch_rejected, report_failures)
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Define output directory - local to TeamFlexCredits
 OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
 os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -25,7 +52,17 @@ SERVICE_KEY = os.getenv("SERVICE_KEY")
 if not SERVICE_KEY:
     raise ValueError("SERVICE_KEY not found in .env file")
 
-API_URL = "https://server.codeium.com/api/v1/Analytics"
+# YYYY-MM-DD with optional zero padding, as datetime.strptime accepts
+DATE_PATTERN = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+
+# Without numpy, aggregations at least this many rows are split across processes
+PARALLEL_AGGREGATE_MIN_ROWS = 1_000_000
+
+# A batch request failed for good: a requests error after the session's
+# retries, a urllib3 error while streaming response.raw (truncated or stalled
+# body), or a body that isn't valid JSON
+FETCH_ERRORS = (requests.RequestException, urllib3.exceptions.HTTPError, ValueError) + (
+    (ijson.JSONError,) if ijson is not None else ())
 
 # Model name mapping for better readability
 MODEL_NAME_MAPPING = {
@@ -58,45 +95,61 @@ def get_friendly_model_name(model):
 
 def parse_date(date_str):
     """Parse date string in YYYY-MM-DD format"""
+    match = DATE_PATTERN.fullmatch(date_str)
     try:
-        return datetime.strptime(date_str, "%Y-%m-%d").strftime("%Y-%m-%d")
+        if match is None:
+            raise ValueError(date_str)
+        year, month, day = map(int, match.groups())
+        datetime(year, month, day)  # Rejects out-of-range months and days
     except ValueError:
         raise ValueError(f"Invalid date format: {date_str}. Please use YYYY-MM-DD format.")
+    return f"{year:04d}-{month:02d}-{day:02d}"
 
 
 def get_month_date_range(year, month):
     """Get start and end dates for a specific month"""
-    start_date = datetime(year, month, 1)
-    if month == 12:
-        end_date = datetime(year + 1, 1, 1) - timedelta(days=1)
-    else:
-        end_date = datetime(year, month + 1, 1) - timedelta(days=1)
-    return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    last_day = calendar.monthrange(year, month)[1]
+    return f"{year:04d}-{month:02d}-01", f"{year:04d}-{month:02d}-{last_day:02d}"
+
+
+def latest_email_mapping_file_in(directory):
+    """Return the newest email_api_mapping_*.json in directory, or None"""
+    try:
+        with os.scandir(directory) as entries:
+            latest = max((entry.name for entry in entries
+                          if entry.name.startswith('email_api_mapping_') and entry.name.endswith('.json')
+                          and entry.is_file()), default=None)
+    except OSError:
+        return None
+    
+    return os.path.join(directory, latest) if latest else None
 
 
 def find_latest_email_mapping_file():
     """Find the latest email_api_mapping file in local output directory, then parent if exists"""
-    import glob
-    
     # First check local output directory
-    local_pattern = os.path.join(OUTPUT_DIR, 'email_api_mapping_*.json')
-    files = glob.glob(local_pattern)
+    latest = latest_email_mapping_file_in(OUTPUT_DIR)
     
     # If not found locally, try parent directory
-    if not files:
+    if latest is None:
         parent_output_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'output')
-        if os.path.exists(parent_output_dir):
-            parent_pattern = os.path.join(parent_output_dir, 'email_api_mapping_*.json')
-            files = glob.glob(parent_pattern)
+        latest = latest_email_mapping_file_in(parent_output_dir)
     
-    return sorted(files)[-1] if files else None
+    return latest
 
 
 def read_api_keys_from_json(json_file_path):
     """Read API keys from JSON file"""
     try:
-        with open(json_file_path, 'r') as json_file:
-            email_api_map = json.load(json_file)
+        with open(json_file_path, 'rb') as json_file:
+            if ijson is not None:
+                try:
+                    # Stream (email, api_key) pairs straight into the inverted map
+                    return {api_key: email for email, api_key in ijson.kvitems(json_file, '')}
+                except ijson.JSONError:
+                    json_file.seek(0)
+            
+            email_api_map = loads_json(json_file.read())
             api_key_email_map = {api_key: email for email, api_key in email_api_map.items()}
             return api_key_email_map
     except Exception as e:
@@ -122,15 +175,14 @@ def generate_email_api_mapping():
         "start_timestamp": start_timestamp,
         "end_timestamp": end_timestamp
     }
-    headers = {"Content-Type": "application/json"}
     
     try:
         # Show progress while making API request
         with tqdm(total=100, desc="⏳ Requesting data", bar_format='{desc}: {bar}', ncols=50) as pbar:
-            response = requests.post(url, json=payload, headers=headers)
+            response = SESSION.post(url, data=dumps_json(payload))
             pbar.update(50)
             response.raise_for_status()
-            data = response.json()
+            data = loads_json(response.content)
             pbar.update(50)
         
         email_api_map = {}
@@ -148,8 +200,8 @@ def generate_email_api_mapping():
             current_date = datetime.now().strftime("%Y-%m-%d")
             output_file = os.path.join(OUTPUT_DIR, f"email_api_mapping_{current_date}.json")
             
-            with open(output_file, "w") as f:
-                json.dump(email_api_map, f, indent=2)
+            with open(output_file, "wb") as f:
+                f.write(dumps_json(email_api_map, indent=True))
             
             print(f"✅ Saved mapping to {output_file}")
             return output_file
@@ -162,8 +214,8 @@ def generate_email_api_mapping():
         return None
 
 
-def create_payload(api_key, start_date, end_date):
-    """Create request payload for a specific API key"""
+def create_payload(api_keys, start_date, end_date):
+    """Create request payload with one query per API key in the batch"""
     return {
         "service_key": SERVICE_KEY,
         "query_requests": [
@@ -181,59 +233,128 @@ def create_payload(api_key, start_date, end_date):
                     {"name": "api_key", "filter": "QUERY_FILTER_EQUAL", "value": api_key}
                 ]
             }
+            for api_key in api_keys
         ]
     }
 
 
-def fetch_data_for_api_key(api_key, start_date, end_date):
-    """Fetch data for a single API key"""
-    payload = create_payload(api_key, start_date, end_date)
-    headers = {"Content-Type": "application/json"}
+def fetch_data_for_api_keys(api_keys, start_date, end_date):
+    """Fetch data for a batch of API keys in a single request
+    
+    Returns the batch, its rows as parallel (dates, models, credits) lists
+    with credits still in hundredths, how many keys in the batch had data,
+    and the failed requests as (api_keys, error) pairs.
+    """
+    body = build_payload_body(create_payload, api_keys, start_date, end_date)
     
     try:
-        response = requests.post(API_URL, headers=headers, data=json.dumps(payload), timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        items = []
-        if "queryResults" in data and data["queryResults"]:
-            for query_result in data["queryResults"]:
-                if "responseItems" in query_result:
-                    for response_item in query_result["responseItems"]:
-                        if "item" in response_item:
-                            items.append(response_item["item"])
-        
-        return api_key, items
-    except:
-        return api_key, []
-
-
-def fetch_parallel(api_keys, start_date, end_date, max_workers=20):
-    """Fetch data in parallel for multiple API keys"""
-    all_items = []
+        with post_analytics(body, stream=True) as response:
+            response.raise_for_status()
+            
+            if ijson is not None:
+                # Parse one query result at a time as the body arrives instead
+                # of materializing the whole response tree
+                response.raw.decode_content = True
+                query_results = ijson.items(response.raw, 'queryResults.item', use_float=True)
+            else:
+                query_results = loads_json(response.content).get("queryResults") or []
+            
+            dates, models, credits = [], [], []
+            active_users = 0
+            answered = 0
+            for query_result in query_results:
+                answered += 1
+                response_items = query_result.get("responseItems")
+                if not response_items:
+                    continue
+                active_users += 1
+                for response_item in response_items:
+                    item = response_item.get("item")
+                    if item is None or not item.get("date"):
+                        continue
+                    # The same few dates/models repeat on every row; interning
+                    # keeps one string object per distinct value
+                    dates.append(sys.intern(item["date"]))
+                    models.append(sys.intern(item.get("model") or "unknown"))
+                    credits.append(safe_float(item.get("flex_credits_used")))
+    except FETCH_ERRORS as e:
+        if not batch_rejected(api_keys, e):
+            # 429/5xx were already retried by the session; report instead of
+            # treating the batch as users without data
+            return api_keys, ([], [], []), 0, [(api_keys, e)]
+        # The server refused the multi-query body; ask per key below
+        answered = 0
+    
+    failures = []
+    if 1 < len(api_keys) != answered:
+        # The server did not answer every query in the batch (or refused
+        # it); ask per key
+        dates, models, credits = [], [], []
+        active_users = 0
+        for api_key in api_keys:
+            _, (key_dates, key_models, key_credits), key_active, key_failures = fetch_data_for_api_keys(
+                [api_key], start_date, end_date)
+            dates.extend(key_dates)
+            models.extend(key_models)
+            credits.extend(key_credits)
+            active_users += key_active
+            failures.extend(key_failures)
+    
+    return api_keys, (dates, models, credits), active_users, failures
+
+
+def fetch_parallel(api_keys, start_date, end_date, max_workers=20, batch_size=10):
+    """Fetch data in parallel for multiple API keys, batch_size keys per request
+    
+    Returns the rows for all keys as parallel (dates, models, credits) columns.
+    """
+    dates, models, credits = [], [], []
     active_users = 0
-    
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(fetch_data_for_api_key, key, start_date, end_date): key 
-                   for key in api_keys}
+    failures = []
+    batches = [api_keys[i:i + batch_size] for i in range(0, len(api_keys), batch_size)]
+    # Requests are blocking I/O that releases the GIL, so threads are enough
+    workers = size_workers(max_workers, len(batches))
+    print(f"⚡ Using {workers} workers\n")
+    if batches:
+        check_gzip_support(build_payload_body(create_payload, batches[0][:1], start_date, end_date))
+    
+    futures = {analytics_client.executor.submit(fetch_data_for_api_keys, batch, start_date, end_date): batch
+               for batch in batches}
+    
+    processed = 0
+    refresh_every = max(1, len(futures) // 100)
+    
+    # Progress bar with tqdm
+    with tqdm(total=len(api_keys), desc="📊 Processing users", 
+              unit="user", bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}{postfix}]',
+              mininterval=0.5) as pbar:
         
-        # Progress bar with tqdm
-        with tqdm(total=len(api_keys), desc="📊 Processing users", 
-                  unit="user", bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]') as pbar:
+        for completed, future in enumerate(as_completed(futures), 1):
+            batch, (batch_dates, batch_models, batch_credits), batch_active, batch_failures = future.result()
+            failures.extend(batch_failures)
             
-            for future in as_completed(futures):
-                api_key, items = future.result()
-                
-                if items:
-                    all_items.extend(items)
-                    active_users += 1
-                    pbar.set_postfix({'active': active_users, 'data_points': len(all_items)})
-                
-                pbar.update(1)
+            if batch_active:
+                dates.extend(batch_dates)
+                models.extend(batch_models)
+                credits.extend(batch_credits)
+                active_users += batch_active
+            
+            # Touch the bar only about once per percent of the batches; every
+            # tqdm call takes its lock and may repaint the line
+            processed += len(batch)
+            if completed % refresh_every == 0 or completed == len(futures):
+                pbar.set_postfix({'workers': workers, 'active': active_users, 'data_points': len(dates)}, refresh=False)
+                pbar.update(processed - pbar.n)
+    
+    print(f"\n✅ Complete! Processed {len(api_keys)} users | Active: {active_users} | Data points: {len(dates)}\n")
+    
+    if failures:
+        report_failures(failures)
     
-    print(f"\n✅ Complete! Processed {len(api_keys)} users | Active: {active_users} | Data points: {len(all_items)}\n")
+    if np is not None:
+        credits = np.asarray(credits, dtype=np.float64)
     
-    return all_items
+    return dates, models, credits
 
 
 def safe_float(value):
@@ -246,28 +367,79 @@ def safe_float(value):
         return 0.0
 
 
-def aggregate_by_date_and_model(items):
-    """Aggregate flex credits by date and model"""
+def factorize(values):
+    """Map values to dense integer codes, returning (levels, codes)"""
+    index = {}
+    codes = np.fromiter((index.setdefault(value, len(index)) for value in values),
+                        dtype=np.intp, count=len(values))
+    return list(index), codes
+
+
+def sum_rows_by_date_and_model(dates, models, credits):
+    """Pure-Python sum of a slice of rows into {date: {model: flex_credits}}"""
+    partial = {}
+    for date, model, flex_credits in zip(dates, models, credits):
+        by_model = partial.get(date)
+        if by_model is None:
+            by_model = partial[date] = {}
+        # Only flex credits (convert from hundredths)
+        by_model[model] = by_model.get(model, 0.0) + flex_credits / 100
+    return partial
+
+
+def aggregate_by_date_and_model(dates, models, credits):
+    """Aggregate flex credits by date and model from parallel row columns"""
     # Structure: {date: {model: flex_credits}}
     daily_model_data = defaultdict(lambda: defaultdict(float))
     
-    for item in items:
-        date = item.get("date", "")
-        model = item.get("model", "unknown")
-        
-        if not date:
-            continue
+    if not dates:
+        return daily_model_data
+    
+    if np is not None:
+        # Factorize dates/models to integer codes and sum each (date, model)
+        # cell with one bincount; the per-row dict loop below is the fallback
+        # without numpy
+        date_levels, date_idx = factorize(dates)
+        model_levels, model_idx = factorize(models)
+        n_dates, n_models = len(date_levels), len(model_levels)
+        flat = date_idx * n_models + model_idx
         
         # Only flex credits (convert from hundredths)
-        flex_credits = safe_float(item.get("flex_credits_used")) / 100
+        totals = np.bincount(flat, weights=np.asarray(credits, dtype=np.float64),
+                             minlength=n_dates * n_models).reshape(n_dates, n_models) / 100.0
+        seen = np.bincount(flat, minlength=n_dates * n_models).reshape(n_dates, n_models) > 0
+        
+        for i, j in zip(*np.nonzero(seen)):
+            daily_model_data[date_levels[i]][model_levels[j]] = float(totals[i, j])
         
-        daily_model_data[date][model] += flex_credits
+        return daily_model_data
+    
+    if len(dates) >= PARALLEL_AGGREGATE_MIN_ROWS:
+        # Shard rows across processes; each returns a small per-date dict
+        # that is cheap to send back and merge
+        chunk = -(-len(dates) // (os.cpu_count() or 1))
+        bounds = range(0, len(dates), chunk)
+        with ProcessPoolExecutor() as pool:
+            partials = list(pool.map(
+                sum_rows_by_date_and_model,
+                [dates[i:i + chunk] for i in bounds],
+                [models[i:i + chunk] for i in bounds],
+                [credits[i:i + chunk] for i in bounds]
+            ))
+    else:
+        partials = [sum_rows_by_date_and_model(dates, models, credits)]
+    
+    for partial in partials:
+        for date, by_model in partial.items():
+            for model, flex_credits in by_model.items():
+                daily_model_data[date][model] += flex_credits
     
     return daily_model_data
 
 
+@lru_cache(maxsize=512)
 def format_date_for_display(date_str):
-    """Format date for display"""
+    """Format date for display (memoized; a report only has a few distinct dates)"""
     try:
         dt = datetime.strptime(date_str, "%Y-%m-%d")
         return dt.strftime("%B %d, %Y")
@@ -282,38 +454,49 @@ def save_results(daily_model_data, month_name, year):
     
     csv_filename = os.path.join(OUTPUT_DIR, f"flex_credits_by_model_{month_name.lower()}_{year}_{current_date}.csv")
     
-    # Prepare rows for CSV
+    # Single pass: CSV rows plus totals per model and per date
     rows = []
     all_models = set()
+    model_totals = defaultdict(float)
+    date_totals = {}
     
     for date in sorted_dates:
+        date_formatted = format_date_for_display(date)
+        date_total = 0
+        date_rows = []
+        
         for model, flex_credits in daily_model_data[date].items():
             all_models.add(model)
-            friendly_name = get_friendly_model_name(model)
-            rows.append({
+            date_rows.append({
                 'event_date': date,
-                'date_formatted': format_date_for_display(date),
+                'date_formatted': date_formatted,
                 'model_internal': model,
-                'model_name': friendly_name,
                 'flex_credits': flex_credits
             })
+            if flex_credits > 0:  # Only count models with flex credits usage
+                model_totals[model] += flex_credits
+                date_total += flex_credits
+        
+        # Dates are already in order, so only each day's rows need sorting
+        # (flex_credits descending)
+        date_rows.sort(key=operator.itemgetter('flex_credits'), reverse=True)
+        rows.extend(date_rows)
+        date_totals[date] = date_total
     
-    # Sort rows by date, then by flex_credits descending
-    rows.sort(key=lambda x: (x['event_date'], -x['flex_credits']))
+    grand_total = sum(date_totals.values())
+    
+    # Resolve each model's display name once instead of once per row
+    friendly = {model: get_friendly_model_name(model) for model in all_models}
     
     # Save to CSV
-    with open(csv_filename, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=['event_date', 'date_formatted', 'model_internal', 'model_name', 'flex_credits'])
-        writer.writeheader()
-        
-        for row in rows:
-            writer.writerow({
-                'event_date': row['event_date'],
-                'date_formatted': row['date_formatted'],
-                'model_internal': row['model_internal'],
-                'model_name': row['model_name'],
-                'flex_credits': f"{row['flex_credits']:.2f}"
-            })
+    with open(csv_filename, 'w', newline='', buffering=1 << 20) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['event_date', 'date_formatted', 'model_internal', 'model_name', 'flex_credits'])
+        writer.writerows([
+            (row['event_date'], row['date_formatted'], row['model_internal'],
+             friendly[row['model_internal']], f"{row['flex_credits']:.2f}")
+            for row in rows
+        ])
     
     print(f"✅ Report saved: {csv_filename}\n")
     
@@ -322,15 +505,8 @@ def save_results(daily_model_data, month_name, year):
     print(f"FLEX CREDITS BY MODEL - {month_name.upper()} {year}")
     print("=" * 100)
     
-    # Calculate totals per model across all dates
-    model_totals = defaultdict(float)
-    grand_total = 0
-    
     for date in sorted_dates:
-        date_formatted = format_date_for_display(date)
-        date_total = 0
-        
-        print(f"\n📅 {date} - {date_formatted}")
+        print(f"\n📅 {date} - {format_date_for_display(date)}")
         print("-" * 100)
         
         # Sort models by flex credits descending for this date
@@ -338,13 +514,9 @@ def save_results(daily_model_data, month_name, year):
         
         for model, flex_credits in models_for_date:
             if flex_credits > 0:  # Only show models with flex credits usage
-                friendly_name = get_friendly_model_name(model)
-                print(f"   {friendly_name:<60} {flex_credits:>15,.2f}")
-                model_totals[model] += flex_credits
-                date_total += flex_credits
+                print(f"   {friendly[model]:<60} {flex_credits:>15,.2f}")
         
-        print(f"   {'DAILY TOTAL':<60} {date_total:>15,.2f}")
-        grand_total += date_total
+        print(f"   {'DAILY TOTAL':<60} {date_totals[date]:>15,.2f}")
     
     # Print totals by model
     print("\n" + "=" * 100)
@@ -353,9 +525,8 @@ def save_results(daily_model_data, month_name, year):
     
     sorted_models = sorted(model_totals.items(), key=lambda x: -x[1])
     for model, total in sorted_models:
-        friendly_name = get_friendly_model_name(model)
         percentage = (total / grand_total * 100) if grand_total > 0 else 0
-        print(f"{friendly_name:<60} {total:>15,.2f}  ({percentage:>5.1f}%)")
+        print(f"{friendly[model]:<60} {total:>15,.2f}  ({percentage:>5.1f}%)")
     
     print("-" * 100)
     print(f"{'GRAND TOTAL':<50} {grand_total:>15,.2f}  (100.0%)")
@@ -369,7 +540,7 @@ def save_results(daily_model_data, month_name, year):
     if len(sorted_dates) > 0:
         print(f"   - Avg flex credits/day: {grand_total / len(sorted_dates):,.2f}")
     
-    days_with_flex = [d for d in sorted_dates if sum(daily_model_data[d].values()) > 0]
+    days_with_flex = [d for d, total in date_totals.items() if total > 0]
     if days_with_flex:
         print(f"\n⚠️  Days with flex credits: {len(days_with_flex)}")
     else:
@@ -389,10 +560,15 @@ def main():
     parser.add_argument('--start-date', type=str, help='Start date YYYY-MM-DD')
     parser.add_argument('--end-date', type=str, help='End date YYYY-MM-DD')
     parser.add_argument('--workers', type=int, default=20, help='Parallel workers (default: 20)')
+    parser.add_argument('--batch-size', type=int, default=10, help='API keys per request (default: 10)')
     parser.add_argument('--json-file', type=str, help='Custom email mapping file')
     
     args = parser.parse_args()
     
+    if args.batch_size < 1:
+        print("Error: Batch size must be ≥ 1")
+        return
+    
     # Determine date range
     if args.start_date and args.end_date:
         start_date = parse_date(args.start_date)
@@ -416,7 +592,12 @@ def main():
     print(f"FLEX CREDITS BY MODEL - {month_name.upper()} {year}")
     print(f"{'='*100}")
     print(f"Date range: {start_date} to {end_date}")
-    print(f"Parallel workers: {args.workers}\n")
+    print(f"Parallel workers: {args.workers}")
+    print(f"Batch size: {args.batch_size} API keys per request\n")
+    
+    # Size the connection pool before the email mapping request so its
+    # keep-alive connection is still there for the fetch
+    size_connection_pool(args.workers)
     
     # Load API keys
     json_file = args.json_file or find_latest_email_mapping_file()
@@ -440,16 +621,15 @@ def main():
     
     # Fetch data in parallel
     print("🚀 Starting parallel data fetch...")
-    print(f"⚡ Using {args.workers} workers for maximum speed\n")
-    items = fetch_parallel(api_keys, start_date, end_date, args.workers)
+    dates, models, credits = fetch_parallel(api_keys, start_date, end_date, args.workers, args.batch_size)
     
-    if not items:
+    if not dates:
         print("❌ No data retrieved")
         return
     
     # Aggregate by date and model
     print("📊 Aggregating results by date and model...")
-    daily_model_data = aggregate_by_date_and_model(items)
+    daily_model_data = aggregate_by_date_and_model(dates, models, credits)
     
     if not daily_model_data:
         print("❌ No flex credits data found")
@@ -0,0 +1,58 @@
+"""
+Team Monthly Credits - Pure-Python Aggregation
+Stdlib-only monthly totals, used when pandas is unavailable or under PyPy.
+"""
+
+# Credit values the API uses to mean "no data"; they count as 0
+NULL_VALUES = frozenset((None, '', '<nil>'))
+
+
+def sum_items_by_month(items):
+    """Aggregate (date, flex_credits_used, prompts_used) tuples by month (YYYY-MM format)"""
+    # Per-month [flex, prompt, total, data_points] accumulators, converted to
+    # the dict-per-month shape once at the end
+    totals = {}
+    
+    # One set lookup per value instead of three comparisons; unhashable or
+    # non-numeric values raise TypeError/ValueError and count as 0
+    nulls = NULL_VALUES
+    to_float = float
+    
+    for date, flex_credits_used, prompts_used in items:
+        if not date:
+            continue
+        
+        # Extract month (YYYY-MM) from date (YYYY-MM-DD)
+        month = date[:7]
+        
+        flex_credits = 0.0
+        try:
+            if flex_credits_used not in nulls:
+                flex_credits = to_float(flex_credits_used) / 100
+        except (ValueError, TypeError):
+            pass
+        
+        prompt_credits = 0.0
+        try:
+            if prompts_used not in nulls:
+                prompt_credits = to_float(prompts_used) / 100
+        except (ValueError, TypeError):
+            pass
+        
+        month_totals = totals.get(month)
+        if month_totals is None:
+            month_totals = totals[month] = [0, 0, 0, 0]
+        month_totals[0] += flex_credits
+        month_totals[1] += prompt_credits
+        month_totals[2] += (flex_credits + prompt_credits)
+        month_totals[3] += 1
+    
+    return {
+        month: {
+            "total_flex_credits": flex,
+            "total_prompt_credits": prompt,
+            "total_credits_used": total,
+            "data_points": points
+        }
+        for month, (flex, prompt, total, points) in totals.items()
+    }
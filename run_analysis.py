@@ -5,25 +5,53 @@ Beautiful interactive interface for running flex credits analysis
 """
 
 import os
+import calendar
+import re
 import sys
-import subprocess
-from datetime import datetime, timedelta
-import questionary
-from questionary import Style
+from datetime import datetime
 
-# Custom style for the CLI
-custom_style = Style([
-    ('qmark', 'fg:#673ab7 bold'),       # Question mark (purple)
-    ('question', 'bold'),                # Question text
-    ('answer', 'fg:#f44336 bold'),       # Selected answer (red)
-    ('pointer', 'fg:#673ab7 bold'),      # Pointer (purple)
-    ('highlighted', 'fg:#673ab7 bold'),  # Highlighted choice (purple)
-    ('selected', 'fg:#cc5454'),          # Selected choice (red)
-    ('separator', 'fg:#cc5454'),         # Separator
-    ('instruction', ''),                 # Instructions
-    ('text', ''),                        # Text
-    ('disabled', 'fg:#858585 italic')    # Disabled
-])
+# questionary (and prompt_toolkit under it) is imported by load_ui() on the
+# first call to main(), so importing this module stays cheap
+questionary = None
+custom_style = None
+MONTH_CHOICES = None
+
+# YYYY-MM-DD with optional zero padding, as datetime.strptime accepts
+DATE_PATTERN = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+
+# (name, number) pairs; the choices return the month number directly
+MONTHS = tuple((name, number) for number, name in enumerate([
+    "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
+    "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"
+], 1))
+
+
+def load_ui():
+    """Import questionary and build the CLI style and month choices once"""
+    global questionary, custom_style, MONTH_CHOICES
+    
+    if questionary is not None:
+        return
+    
+    import questionary as questionary_module
+    from questionary import Style
+    
+    # Custom style for the CLI
+    custom_style = Style([
+        ('qmark', 'fg:#673ab7 bold'),       # Question mark (purple)
+        ('question', 'bold'),                # Question text
+        ('answer', 'fg:#f44336 bold'),       # Selected answer (red)
+        ('pointer', 'fg:#673ab7 bold'),      # Pointer (purple)
+        ('highlighted', 'fg:#673ab7 bold'),  # Highlighted choice (purple)
+        ('selected', 'fg:#cc5454'),          # Selected choice (red)
+        ('separator', 'fg:#cc5454'),         # Separator
+        ('instruction', ''),                 # Instructions
+        ('text', ''),                        # Text
+        ('disabled', 'fg:#858585 italic')    # Disabled
+    ])
+    
+    MONTH_CHOICES = [questionary_module.Choice(f"{name} ({number})", value=number) for name, number in MONTHS]
+    questionary = questionary_module
 
 
 def print_banner():
@@ -42,44 +70,94 @@ def print_banner():
 
 def get_month_dates(year, month):
     """Calculate start and end dates for a month"""
-    start_date = datetime(year, month, 1)
-    if month == 12:
-        end_date = datetime(year + 1, 1, 1) - timedelta(days=1)
-    else:
-        end_date = datetime(year, month + 1, 1) - timedelta(days=1)
-    return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    last_day = calendar.monthrange(year, month)[1]
+    return f"{year:04d}-{month:02d}-01", f"{year:04d}-{month:02d}-{last_day:02d}"
 
 
 def validate_date(date_str):
     """Validate date format YYYY-MM-DD"""
+    match = DATE_PATTERN.fullmatch(date_str)
+    if match:
+        try:
+            datetime(*map(int, match.groups()))
+            return True
+        except ValueError:
+            pass
+    return "❌ Formato inválido. Usa YYYY-MM-DD (ejemplo: 2025-09-01)"
+
+
+def latest_email_mapping_file_in(directory):
+    """Return the newest email_api_mapping_*.json in directory, or None"""
     try:
-        datetime.strptime(date_str, "%Y-%m-%d")
-        return True
-    except ValueError:
-        return "❌ Formato inválido. Usa YYYY-MM-DD (ejemplo: 2025-09-01)"
+        with os.scandir(directory) as entries:
+            latest = max((entry.name for entry in entries
+                          if entry.name.startswith('email_api_mapping_') and entry.name.endswith('.json')
+                          and entry.is_file()), default=None)
+    except OSError:
+        return None
+    
+    return os.path.join(directory, latest) if latest else None
 
 
 def find_email_mapping_files():
-    """Find available email mapping files"""
-    import glob
+    """Find the latest email mapping file in each output directory (newest last)"""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
     
-    # Check parent output directory
-    parent_output = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'output')
-    pattern = os.path.join(parent_output, 'email_api_mapping_*.json')
-    files = glob.glob(pattern)
+    # Check parent output directory, then local output directory
+    candidates = (
+        latest_email_mapping_file_in(os.path.join(script_dir, '..', 'output')),
+        latest_email_mapping_file_in(os.path.join(script_dir, 'output'))
+    )
     
-    # Also check local output directory
-    local_output = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
-    local_pattern = os.path.join(local_output, 'email_api_mapping_*.json')
-    files.extend(glob.glob(local_pattern))
+    return sorted((path for path in candidates if path), key=os.path.basename)
+
+
+def validate_year(year_str):
+    """Validate year between 2020 and 2030"""
+    if year_str.isdigit() and 2020 <= int(year_str) <= 2030:
+        return True
+    return "❌ Año inválido (2020-2030)"
+
+
+def ask_year():
+    """Ask for a year, defaulting to the current one; None if cancelled"""
+    year = questionary.text(
+        "¿Qué año?",
+        default=str(datetime.now().year),
+        validate=validate_year
+    ).ask()
     
-    return sorted(set(files))
+    return int(year) if year is not None else None
+
+
+def ask_month(question, first=1):
+    """Ask for a month number from first to 12; None if cancelled"""
+    return questionary.select(
+        question,
+        choices=MONTH_CHOICES[first-1:],
+        style=custom_style
+    ).ask()
+
+
+def build_command(script_dir, script_name, start_date, end_date, workers, json_file):
+    """Build the command line for one of the analysis scripts"""
+    cmd = [
+        sys.executable,
+        os.path.join(script_dir, script_name),
+        "--start-date", start_date,
+        "--end-date", end_date,
+        "--workers", workers
+    ]
+    if json_file:
+        cmd.extend(["--json-file", json_file])
+    return cmd
 
 
 def main():
     """Main interactive CLI"""
     
     print_banner()
+    load_ui()
     
     # Step 1: Choose analysis type
     analysis_type = questionary.select(
@@ -118,90 +196,43 @@ def main():
     # Step 3: Get date parameters
     if date_range_type == "month_range":
         # Choose year
-        current_year = datetime.now().year
-        year = questionary.text(
-            "¿Qué año?",
-            default=str(current_year),
-            validate=lambda x: x.isdigit() and 2020 <= int(x) <= 2030 or "❌ Año inválido (2020-2030)"
-        ).ask()
+        year = ask_year()
         
         if year is None:
             return main()
         
-        year = int(year)
-        
         # Choose start month
-        months = [
-            "Enero (1)", "Febrero (2)", "Marzo (3)", "Abril (4)",
-            "Mayo (5)", "Junio (6)", "Julio (7)", "Agosto (8)",
-            "Septiembre (9)", "Octubre (10)", "Noviembre (11)", "Diciembre (12)"
-        ]
-        
-        start_month_choice = questionary.select(
-            "¿Mes inicial?",
-            choices=months,
-            style=custom_style
-        ).ask()
+        start_month = ask_month("¿Mes inicial?")
         
-        if start_month_choice is None:
+        if start_month is None:
             return main()
         
-        start_month = int(start_month_choice.split("(")[1].rstrip(")"))
-        
         # Choose end month
-        end_month_choice = questionary.select(
-            "¿Mes final?",
-            choices=months[start_month-1:],  # Only show months >= start month
-            style=custom_style
-        ).ask()
+        end_month = ask_month("¿Mes final?", first=start_month)  # Only show months >= start month
         
-        if end_month_choice is None:
+        if end_month is None:
             return main()
         
-        end_month = int(end_month_choice.split("(")[1].rstrip(")"))
-        
         # Calculate date range
-        start_date = datetime(year, start_month, 1).strftime("%Y-%m-%d")
-        if end_month == 12:
-            end_date = datetime(year + 1, 1, 1) - timedelta(days=1)
-        else:
-            end_date = datetime(year, end_month + 1, 1) - timedelta(days=1)
-        end_date = end_date.strftime("%Y-%m-%d")
+        start_date, _ = get_month_dates(year, start_month)
+        _, end_date = get_month_dates(year, end_month)
         
-        print(f"\n✅ Rango seleccionado: {start_month_choice.split('(')[0].strip()} a {end_month_choice.split('(')[0].strip()} de {year}")
+        print(f"\n✅ Rango seleccionado: {MONTHS[start_month-1][0]} a {MONTHS[end_month-1][0]} de {year}")
         print(f"   ({start_date} a {end_date})")
         
     elif date_range_type == "month":
         # Choose year
-        current_year = datetime.now().year
-        year = questionary.text(
-            "¿Qué año?",
-            default=str(current_year),
-            validate=lambda x: x.isdigit() and 2020 <= int(x) <= 2030 or "❌ Año inválido (2020-2030)"
-        ).ask()
+        year = ask_year()
         
         if year is None:
             return main()
         
-        year = int(year)
-        
         # Choose month
-        months = [
-            "Enero (1)", "Febrero (2)", "Marzo (3)", "Abril (4)",
-            "Mayo (5)", "Junio (6)", "Julio (7)", "Agosto (8)",
-            "Septiembre (9)", "Octubre (10)", "Noviembre (11)", "Diciembre (12)"
-        ]
-        
-        month_choice = questionary.select(
-            "¿Qué mes?",
-            choices=months,
-            style=custom_style
-        ).ask()
+        month = ask_month("¿Qué mes?")
         
-        if month_choice is None:
+        if month is None:
             return main()
         
-        month = int(month_choice.split("(")[1].rstrip(")"))
         start_date, end_date = get_month_dates(year, month)
         
         print(f"\n✅ Rango seleccionado: {start_date} a {end_date}")
@@ -245,9 +276,9 @@ def main():
     json_file = None
     
     if available_files:
-        print(f"\n✅ Se encontraron {len(available_files)} archivo(s) de mapeo")
+        print(f"\n✅ Archivo de mapeo más reciente: {os.path.basename(available_files[-1])}")
         use_default = questionary.confirm(
-            f"¿Usar el archivo más reciente? ({os.path.basename(available_files[-1])})",
+            "¿Usar este archivo?",
             default=True,
             style=custom_style
         ).ask()
@@ -268,6 +299,12 @@ def main():
         print("\n⚠️  No se encontró archivo de mapeo automáticamente")
         print("💡 El script lo generará automáticamente si es necesario")
     
+    # With a mapping file, "both" runs the two analyses at the same time; they
+    # split the worker budget so together they open as many connections as
+    # one analysis would
+    run_concurrently = analysis_type == "both" and bool(json_file)
+    script_workers = str(max(1, int(workers) // 2)) if run_concurrently else workers
+    
     # Step 6: Confirmation
     print("\n" + "="*70)
     print("📋 RESUMEN DE CONFIGURACIÓN")
@@ -283,7 +320,10 @@ def main():
         print("📊 Análisis: Ambos (totales + por modelo)")
     
     print(f"📅 Período: {start_date} a {end_date}")
-    print(f"⚡ Workers: {workers}")
+    if run_concurrently:
+        print(f"⚡ Workers: {workers} ({script_workers} por análisis, se ejecutan a la vez)")
+    else:
+        print(f"⚡ Workers: {workers}")
     if json_file:
         print(f"📁 Archivo mapeo: {os.path.basename(json_file)}")
     else:
@@ -301,6 +341,10 @@ def main():
         return
     
     # Step 7: Execute the script(s)
+    import shutil
+    import subprocess
+    import tempfile
+    
     print("\n🚀 Iniciando análisis...\n")
     print("="*70 + "\n")
     
@@ -308,15 +352,7 @@ def main():
     
     if analysis_type == "monthly":
         print("📆 Ejecutando: Resumen mensual de credits\n")
-        cmd = [
-            sys.executable,
-            os.path.join(script_dir, "team_monthly_credits.py"),
-            "--start-date", start_date,
-            "--end-date", end_date,
-            "--workers", workers
-        ]
-        if json_file:
-            cmd.extend(["--json-file", json_file])
+        cmd = build_command(script_dir, "team_monthly_credits.py", start_date, end_date, workers, json_file)
         
         result = subprocess.run(cmd)
         
@@ -324,22 +360,30 @@ def main():
             print("\n❌ Error al ejecutar el análisis mensual")
             return
     
-    elif analysis_type in ["daily", "both"]:
+    # With a mapping file both analyses can run at once; without one each script
+    # may generate it, so they run one after the other
+    by_model_process = None
+    by_model_output = None
+    
+    if run_concurrently:
+        # Start the model breakdown in the background and replay its output once
+        # the daily totals finish, so the two progress bars don't interleave
+        cmd = build_command(script_dir, "flex_credits_by_model.py", start_date, end_date, script_workers, json_file)
+        by_model_output = tempfile.TemporaryFile()
+        by_model_process = subprocess.Popen(cmd, stdout=by_model_output, stderr=subprocess.STDOUT)
+    
+    if analysis_type in ["daily", "both"]:
         print("📊 Ejecutando: Totales diarios de flex credits\n")
-        cmd = [
-            sys.executable,
-            os.path.join(script_dir, "team_daily_flex_credits.py"),
-            "--start-date", start_date,
-            "--end-date", end_date,
-            "--workers", workers
-        ]
-        if json_file:
-            cmd.extend(["--json-file", json_file])
+        cmd = build_command(script_dir, "team_daily_flex_credits.py", start_date, end_date, script_workers, json_file)
         
         result = subprocess.run(cmd)
         
         if result.returncode != 0:
             print("\n❌ Error al ejecutar el análisis de totales diarios")
+            if by_model_process is not None:
+                by_model_process.terminate()
+                by_model_process.wait()
+                by_model_output.close()
             return
         
         if analysis_type == "both":
@@ -347,19 +391,19 @@ def main():
     
     if analysis_type in ["by_model", "both"]:
         print("🤖 Ejecutando: Desglose por modelo de lenguaje\n")
-        cmd = [
-            sys.executable,
-            os.path.join(script_dir, "flex_credits_by_model.py"),
-            "--start-date", start_date,
-            "--end-date", end_date,
-            "--workers", workers
-        ]
-        if json_file:
-            cmd.extend(["--json-file", json_file])
         
-        result = subprocess.run(cmd)
+        if by_model_process is not None:
+            returncode = by_model_process.wait()
+            by_model_output.seek(0)
+            sys.stdout.flush()
+            shutil.copyfileobj(by_model_output, sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+            by_model_output.close()
+        else:
+            cmd = build_command(script_dir, "flex_credits_by_model.py", start_date, end_date, script_workers, json_file)
+            returncode = subprocess.run(cmd).returncode
         
-        if result.returncode != 0:
+        if returncode != 0:
             print("\n❌ Error al ejecutar el análisis por modelo")
             return
     
@@ -5,16 +5,35 @@ Fast parallel processing for large teams (thousands of users).
 """
 
 import os
-import json
+import calendar
+import re
 import requests
 import csv
 import argparse
 from datetime import datetime, timedelta
 from collections import defaultdict
+from functools import lru_cache
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 from tqdm import tqdm
 
+# HTTP session, worker pool and request helpers shared by the report scripts
+try:
+    from . import analytics_client
+    from .analytics_client import (SESSION, dumps_json, loads_json, build_payload_body, size_connection_pool,
+                                   size_workers, check_gzip_support, post_analytics,
+                                   batch_rejected, report_failures)
+except ImportError:
+    import analytics_client
+    from analytics_client import (SESSION, dumps_json, loads_json, build_payload_body, size_connection_pool,
+                                  size_workers, check_gzip_support, post_analytics,
+                                  batch_rejected, report_failures)
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 # Define output directory - local to TeamFlexCredits
 OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
 os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -25,50 +44,67 @@ SERVICE_KEY = os.getenv("SERVICE_KEY")
 if not SERVICE_KEY:
     raise ValueError("SERVICE_KEY not found in .env file")
 
-API_URL = "https://server.codeium.com/api/v1/Analytics"
+# YYYY-MM-DD with optional zero padding, as datetime.strptime accepts
+DATE_PATTERN = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
 
 
 def parse_date(date_str):
     """Parse date string in YYYY-MM-DD format"""
+    match = DATE_PATTERN.fullmatch(date_str)
     try:
-        return datetime.strptime(date_str, "%Y-%m-%d").strftime("%Y-%m-%d")
+        if match is None:
+            raise ValueError(date_str)
+        year, month, day = map(int, match.groups())
+        datetime(year, month, day)  # Rejects out-of-range months and days
     except ValueError:
         raise ValueError(f"Invalid date format: {date_str}. Please use YYYY-MM-DD format.")
+    return f"{year:04d}-{month:02d}-{day:02d}"
 
 
 def get_month_date_range(year, month):
     """Get start and end dates for a specific month"""
-    start_date = datetime(year, month, 1)
-    if month == 12:
-        end_date = datetime(year + 1, 1, 1) - timedelta(days=1)
-    else:
-        end_date = datetime(year, month + 1, 1) - timedelta(days=1)
-    return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    last_day = calendar.monthrange(year, month)[1]
+    return f"{year:04d}-{month:02d}-01", f"{year:04d}-{month:02d}-{last_day:02d}"
+
+
+def latest_email_mapping_file_in(directory):
+    """Return the newest email_api_mapping_*.json in directory, or None"""
+    try:
+        with os.scandir(directory) as entries:
+            latest = max((entry.name for entry in entries
+                          if entry.name.startswith('email_api_mapping_') and entry.name.endswith('.json')
+                          and entry.is_file()), default=None)
+    except OSError:
+        return None
+    
+    return os.path.join(directory, latest) if latest else None
 
 
 def find_latest_email_mapping_file():
     """Find the latest email_api_mapping file in local output directory, then parent if exists"""
-    import glob
-    
     # First check local output directory
-    local_pattern = os.path.join(OUTPUT_DIR, 'email_api_mapping_*.json')
-    files = glob.glob(local_pattern)
+    latest = latest_email_mapping_file_in(OUTPUT_DIR)
     
     # If not found locally, try parent directory
-    if not files:
+    if latest is None:
         parent_output_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'output')
-        if os.path.exists(parent_output_dir):
-            parent_pattern = os.path.join(parent_output_dir, 'email_api_mapping_*.json')
-            files = glob.glob(parent_pattern)
+        latest = latest_email_mapping_file_in(parent_output_dir)
     
-    return sorted(files)[-1] if files else None
+    return latest
 
 
 def read_api_keys_from_json(json_file_path):
     """Read API keys from JSON file"""
     try:
-        with open(json_file_path, 'r') as json_file:
-            email_api_map = json.load(json_file)
+        with open(json_file_path, 'rb') as json_file:
+            if ijson is not None:
+                try:
+                    # Stream (email, api_key) pairs straight into the inverted map
+                    return {api_key: email for email, api_key in ijson.kvitems(json_file, '')}
+                except ijson.JSONError:
+                    json_file.seek(0)
+            
+            email_api_map = loads_json(json_file.read())
             api_key_email_map = {api_key: email for email, api_key in email_api_map.items()}
             return api_key_email_map
     except Exception as e:
@@ -94,15 +130,14 @@ def generate_email_api_mapping():
         "start_timestamp": start_timestamp,
         "end_timestamp": end_timestamp
     }
-    headers = {"Content-Type": "application/json"}
     
     try:
         # Show progress while making API request
         with tqdm(total=100, desc="⏳ Requesting data", bar_format='{desc}: {bar}', ncols=50) as pbar:
-            response = requests.post(url, json=payload, headers=headers)
+            response = SESSION.post(url, data=dumps_json(payload))
             pbar.update(50)
             response.raise_for_status()
-            data = response.json()
+            data = loads_json(response.content)
             pbar.update(50)
         
         email_api_map = {}
@@ -120,8 +155,8 @@ def generate_email_api_mapping():
             current_date = datetime.now().strftime("%Y-%m-%d")
             output_file = os.path.join(OUTPUT_DIR, f"email_api_mapping_{current_date}.json")
             
-            with open(output_file, "w") as f:
-                json.dump(email_api_map, f, indent=2)
+            with open(output_file, "wb") as f:
+                f.write(dumps_json(email_api_map, indent=True))
             
             print(f"✅ Saved mapping to {output_file}")
             return output_file
@@ -134,8 +169,8 @@ def generate_email_api_mapping():
         return None
 
 
-def create_payload(api_key, start_date, end_date):
-    """Create request payload for a specific API key"""
+def create_payload(api_keys, start_date, end_date):
+    """Create request payload with one query per API key in the batch"""
     return {
         "service_key": SERVICE_KEY,
         "query_requests": [
@@ -154,58 +189,97 @@ def create_payload(api_key, start_date, end_date):
                     {"name": "api_key", "filter": "QUERY_FILTER_EQUAL", "value": api_key}
                 ]
             }
+            for api_key in api_keys
         ]
     }
 
 
-def fetch_data_for_api_key(api_key, start_date, end_date):
-    """Fetch data for a single API key"""
-    payload = create_payload(api_key, start_date, end_date)
-    headers = {"Content-Type": "application/json"}
+def fetch_data_for_api_keys(api_keys, start_date, end_date):
+    """Fetch data for a batch of API keys in a single request
+    
+    Returns the batch, one list of items per API key in batch order, and the
+    failed requests as (api_keys, error) pairs.
+    """
+    body = build_payload_body(create_payload, api_keys, start_date, end_date)
     
     try:
-        response = requests.post(API_URL, headers=headers, data=json.dumps(payload), timeout=10)
+        response = post_analytics(body)
         response.raise_for_status()
-        data = response.json()
-        
-        items = []
-        if "queryResults" in data and data["queryResults"]:
-            for query_result in data["queryResults"]:
-                if "responseItems" in query_result:
-                    for response_item in query_result["responseItems"]:
-                        if "item" in response_item:
-                            items.append(response_item["item"])
-        
-        return api_key, items
-    except:
-        return api_key, []
-
-
-def fetch_parallel(api_keys, start_date, end_date, max_workers=20):
-    """Fetch data in parallel for multiple API keys"""
+        data = loads_json(response.content)
+    except (requests.RequestException, ValueError) as e:
+        if not batch_rejected(api_keys, e):
+            # 429/5xx were already retried by the session; report instead of
+            # treating the batch as users without data
+            return api_keys, [], [(api_keys, e)]
+        # The server refused the multi-query body; ask per key below
+        data = {}
+    
+    results = []
+    if "queryResults" in data and data["queryResults"]:
+        for query_result in data["queryResults"]:
+            items = []
+            if "responseItems" in query_result:
+                for response_item in query_result["responseItems"]:
+                    if "item" in response_item:
+                        items.append(response_item["item"])
+            results.append(items)
+    
+    failures = []
+    if 1 < len(api_keys) != len(results):
+        # The server did not answer every query in the batch; ask per key
+        results = []
+        for api_key in api_keys:
+            _, key_results, key_failures = fetch_data_for_api_keys([api_key], start_date, end_date)
+            results.extend(key_results)
+            failures.extend(key_failures)
+    
+    return api_keys, results, failures
+
+
+def fetch_parallel(api_keys, start_date, end_date, max_workers=20, batch_size=10):
+    """Fetch data in parallel for multiple API keys, batch_size keys per request"""
     all_items = []
     active_users = 0
-    
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(fetch_data_for_api_key, key, start_date, end_date): key 
-                   for key in api_keys}
+    failures = []
+    batches = [api_keys[i:i + batch_size] for i in range(0, len(api_keys), batch_size)]
+    # Requests are blocking I/O that releases the GIL, so threads are enough
+    workers = size_workers(max_workers, len(batches))
+    print(f"⚡ Using {workers} workers\n")
+    if batches:
+        check_gzip_support(build_payload_body(create_payload, batches[0][:1], start_date, end_date))
+    
+    futures = {analytics_client.executor.submit(fetch_data_for_api_keys, batch, start_date, end_date): batch
+               for batch in batches}
+    
+    processed = 0
+    refresh_every = max(1, len(futures) // 100)
+    
+    # Progress bar with tqdm
+    with tqdm(total=len(api_keys), desc="📊 Processing users", 
+              unit="user", bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}{postfix}]',
+              mininterval=0.5) as pbar:
         
-        # Progress bar with tqdm
-        with tqdm(total=len(api_keys), desc="📊 Processing users", 
-                  unit="user", bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]') as pbar:
+        for completed, future in enumerate(as_completed(futures), 1):
+            batch, results, batch_failures = future.result()
+            failures.extend(batch_failures)
             
-            for future in as_completed(futures):
-                api_key, items = future.result()
-                
+            for items in results:
                 if items:
                     all_items.extend(items)
                     active_users += 1
-                    pbar.set_postfix({'active': active_users, 'data_points': len(all_items)})
-                
-                pbar.update(1)
+            
+            # Touch the bar only about once per percent of the batches; every
+            # tqdm call takes its lock and may repaint the line
+            processed += len(batch)
+            if completed % refresh_every == 0 or completed == len(futures):
+                pbar.set_postfix({'workers': workers, 'active': active_users, 'data_points': len(all_items)}, refresh=False)
+                pbar.update(processed - pbar.n)
     
     print(f"\n✅ Complete! Processed {len(api_keys)} users | Active: {active_users} | Data points: {len(all_items)}\n")
     
+    if failures:
+        report_failures(failures)
+    
     return all_items
 
 
@@ -242,8 +316,9 @@ def aggregate_by_date(items):
     return daily_data
 
 
+@lru_cache(maxsize=512)
 def format_date_for_display(date_str):
-    """Format date for display"""
+    """Format date for display (memoized; a report only has a few distinct dates)"""
     try:
         dt = datetime.strptime(date_str, "%Y-%m-%d")
         return dt.strftime("%B %d, %Y")
@@ -258,19 +333,15 @@ def save_results(daily_data, month_name, year):
     
     csv_filename = os.path.join(OUTPUT_DIR, f"team_daily_flex_credits_{month_name.lower()}_{year}_{current_date}.csv")
     
-    with open(csv_filename, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=['event_date', 'date_formatted', 'total_flex_credits', 'total_prompt_credits', 'data_points'])
-        writer.writeheader()
-        
-        for date in sorted_dates:
-            data = daily_data[date]
-            writer.writerow({
-                'event_date': date,
-                'date_formatted': format_date_for_display(date),
-                'total_flex_credits': f"{data['total_flex_credits']:.2f}",
-                'total_prompt_credits': f"{data['total_prompt_credits']:.2f}",
-                'data_points': data['data_points']
-            })
+    with open(csv_filename, 'w', newline='', buffering=1 << 20) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['event_date', 'date_formatted', 'total_flex_credits', 'total_prompt_credits', 'data_points'])
+        writer.writerows(
+            (date, format_date_for_display(date),
+             f"{data['total_flex_credits']:.2f}", f"{data['total_prompt_credits']:.2f}",
+             data['data_points'])
+            for date, data in ((date, daily_data[date]) for date in sorted_dates)
+        )
     
     print(f"✅ Report saved: {csv_filename}\n")
     
@@ -322,10 +393,15 @@ def main():
     parser.add_argument('--start-date', type=str, help='Start date YYYY-MM-DD')
     parser.add_argument('--end-date', type=str, help='End date YYYY-MM-DD')
     parser.add_argument('--workers', type=int, default=20, help='Parallel workers (default: 20)')
+    parser.add_argument('--batch-size', type=int, default=10, help='API keys per request (default: 10)')
     parser.add_argument('--json-file', type=str, help='Custom email mapping file')
     
     args = parser.parse_args()
     
+    if args.batch_size < 1:
+        print("Error: Batch size must be ≥ 1")
+        return
+    
     # Determine date range
     if args.start_date and args.end_date:
         start_date = parse_date(args.start_date)
@@ -349,7 +425,12 @@ def main():
     print(f"TEAM FLEX CREDITS - {month_name.upper()} {year}")
     print(f"{'='*100}")
     print(f"Date range: {start_date} to {end_date}")
-    print(f"Parallel workers: {args.workers}\n")
+    print(f"Parallel workers: {args.workers}")
+    print(f"Batch size: {args.batch_size} API keys per request\n")
+    
+    # Size the connection pool before the email mapping request so its
+    # keep-alive connection is still there for the fetch
+    size_connection_pool(args.workers)
     
     # Load API keys
     json_file = args.json_file or find_latest_email_mapping_file()
@@ -373,8 +454,7 @@ def main():
     
     # Fetch data in parallel
     print("🚀 Starting parallel data fetch...")
-    print(f"⚡ Using {args.workers} workers for maximum speed\n")
-    items = fetch_parallel(api_keys, start_date, end_date, args.workers)
+    items = fetch_parallel(api_keys, start_date, end_date, args.workers, args.batch_size)
     
     if not items:
         print("❌ No data retrieved")
@@ -5,16 +5,44 @@ Aggregate flex credits and prompt credits by month for a date range.
 """
 
 import os
-import json
+import calendar
+import re
+import sys
 import requests
 import csv
 import argparse
 from datetime import datetime, timedelta
-from collections import defaultdict
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import as_completed
 from tqdm import tqdm
 
+# HTTP session, worker pool and request helpers shared by the report scripts
+try:
+    from . import analytics_client
+    from .analytics_client import (SESSION, dumps_json, loads_json, build_payload_body, size_connection_pool,
+                                   size_workers, check_gzip_support, post_analytics,
+                                   batch_rejected, report_failures)
+except ImportError:
+    import analytics_client
+    from analytics_client import (SESSION, dumps_json, loads_json, build_payload_body, size_connection_pool,
+                                  size_workers, check_gzip_support, post_analytics,
+                                  batch_rejected, report_failures)
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# pandas runs through PyPy's slow C-API emulation, so under PyPy the
+# pure-Python aggregation in monthly_core is used instead
+if sys.implementation.name == "pypy":
+    pd = None
+else:
+    try:
+        import pandas as pd
+    except ImportError:
+        pd = None
+
 # Define output directory
 OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
 os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -25,50 +53,72 @@ SERVICE_KEY = os.getenv("SERVICE_KEY")
 if not SERVICE_KEY:
     raise ValueError("SERVICE_KEY not found in .env file")
 
-API_URL = "https://server.codeium.com/api/v1/Analytics"
+# YYYY-MM-DD with optional zero padding, as datetime.strptime accepts
+DATE_PATTERN = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+
+MONTH_NAMES = (
+    "January", "February", "March", "April", "May", "June",
+    "July", "August", "September", "October", "November", "December"
+)
 
 
 def parse_date(date_str):
     """Parse date string in YYYY-MM-DD format"""
+    match = DATE_PATTERN.fullmatch(date_str)
     try:
-        return datetime.strptime(date_str, "%Y-%m-%d").strftime("%Y-%m-%d")
+        if match is None:
+            raise ValueError(date_str)
+        year, month, day = map(int, match.groups())
+        datetime(year, month, day)  # Rejects out-of-range months and days
     except ValueError:
         raise ValueError(f"Invalid date format: {date_str}. Please use YYYY-MM-DD format.")
+    return f"{year:04d}-{month:02d}-{day:02d}"
 
 
 def get_month_range(year, start_month, end_month):
     """Get start and end dates for a range of months"""
-    start_date = datetime(year, start_month, 1)
-    
-    if end_month == 12:
-        end_date = datetime(year + 1, 1, 1) - timedelta(days=1)
-    else:
-        end_date = datetime(year, end_month + 1, 1) - timedelta(days=1)
+    last_day = calendar.monthrange(year, end_month)[1]
+    return f"{year:04d}-{start_month:02d}-01", f"{year:04d}-{end_month:02d}-{last_day:02d}"
+
+
+def latest_email_mapping_file_in(directory):
+    """Return the newest email_api_mapping_*.json in directory, or None"""
+    try:
+        with os.scandir(directory) as entries:
+            latest = max((entry.name for entry in entries
+                          if entry.name.startswith('email_api_mapping_') and entry.name.endswith('.json')
+                          and entry.is_file()), default=None)
+    except OSError:
+        return None
     
-    return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    return os.path.join(directory, latest) if latest else None
 
 
 def find_latest_email_mapping_file():
     """Find the latest email_api_mapping file"""
-    import glob
+    # First check local output directory
+    latest = latest_email_mapping_file_in(OUTPUT_DIR)
     
-    local_pattern = os.path.join(OUTPUT_DIR, 'email_api_mapping_*.json')
-    files = glob.glob(local_pattern)
-    
-    if not files:
+    # If not found locally, try parent directory
+    if latest is None:
         parent_output_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'output')
-        if os.path.exists(parent_output_dir):
-            parent_pattern = os.path.join(parent_output_dir, 'email_api_mapping_*.json')
-            files = glob.glob(parent_pattern)
+        latest = latest_email_mapping_file_in(parent_output_dir)
     
-    return sorted(files)[-1] if files else None
+    return latest
 
 
 def read_api_keys_from_json(json_file_path):
     """Read API keys from JSON file"""
     try:
-        with open(json_file_path, 'r') as json_file:
-            email_api_map = json.load(json_file)
+        with open(json_file_path, 'rb') as json_file:
+            if ijson is not None:
+                try:
+                    # Stream (email, api_key) pairs straight into the inverted map
+                    return {api_key: email for email, api_key in ijson.kvitems(json_file, '')}
+                except ijson.JSONError:
+                    json_file.seek(0)
+            
+            email_api_map = loads_json(json_file.read())
             api_key_email_map = {api_key: email for email, api_key in email_api_map.items()}
             return api_key_email_map
     except Exception as e:
@@ -93,14 +143,13 @@ def generate_email_api_mapping():
         "start_timestamp": start_timestamp,
         "end_timestamp": end_timestamp
     }
-    headers = {"Content-Type": "application/json"}
     
     try:
         with tqdm(total=100, desc="⏳ Requesting data", bar_format='{desc}: {bar}', ncols=50) as pbar:
-            response = requests.post(url, json=payload, headers=headers)
+            response = SESSION.post(url, data=dumps_json(payload))
             pbar.update(50)
             response.raise_for_status()
-            data = response.json()
+            data = loads_json(response.content)
             pbar.update(50)
         
         email_api_map = {}
@@ -116,8 +165,8 @@ def generate_email_api_mapping():
             current_date = datetime.now().strftime("%Y-%m-%d")
             output_file = os.path.join(OUTPUT_DIR, f"email_api_mapping_{current_date}.json")
             
-            with open(output_file, "w") as f:
-                json.dump(email_api_map, f, indent=2)
+            with open(output_file, "wb") as f:
+                f.write(dumps_json(email_api_map, indent=True))
             
             print(f"✅ Saved mapping to {output_file}")
             return output_file
@@ -130,8 +179,8 @@ def generate_email_api_mapping():
         return None
 
 
-def create_payload(api_key, start_date, end_date):
-    """Create request payload for a specific API key"""
+def create_payload(api_keys, start_date, end_date):
+    """Create request payload with one query per API key in the batch"""
     return {
         "service_key": SERVICE_KEY,
         "query_requests": [
@@ -150,105 +199,146 @@ def create_payload(api_key, start_date, end_date):
                     {"name": "api_key", "filter": "QUERY_FILTER_EQUAL", "value": api_key}
                 ]
             }
+            for api_key in api_keys
         ]
     }
 
 
-def fetch_data_for_api_key(api_key, start_date, end_date):
-    """Fetch data for a single API key"""
-    payload = create_payload(api_key, start_date, end_date)
-    headers = {"Content-Type": "application/json"}
+def fetch_data_for_api_keys(api_keys, start_date, end_date):
+    """Fetch data for a batch of API keys in a single request
+    
+    Returns the batch, per API key in batch order a list of
+    (date, flex_credits_used, prompts_used) tuples, and the failed requests
+    as (api_keys, error) pairs.
+    """
+    body = build_payload_body(create_payload, api_keys, start_date, end_date)
     
     try:
-        response = requests.post(API_URL, headers=headers, data=json.dumps(payload), timeout=10)
+        response = post_analytics(body)
         response.raise_for_status()
-        data = response.json()
-        
-        items = []
-        if "queryResults" in data and data["queryResults"]:
-            for query_result in data["queryResults"]:
-                if "responseItems" in query_result:
-                    for response_item in query_result["responseItems"]:
-                        if "item" in response_item:
-                            items.append(response_item["item"])
-        
-        return api_key, items
-    except:
-        return api_key, []
-
-
-def fetch_parallel(api_keys, start_date, end_date, max_workers=20):
-    """Fetch data in parallel for multiple API keys"""
+        data = loads_json(response.content)
+    except (requests.RequestException, ValueError) as e:
+        if not batch_rejected(api_keys, e):
+            # 429/5xx were already retried by the session; report instead of
+            # treating the batch as users without data
+            return api_keys, [], [(api_keys, e)]
+        # The server refused the multi-query body; ask per key below
+        data = {}
+    
+    results = []
+    if "queryResults" in data and data["queryResults"]:
+        for query_result in data["queryResults"]:
+            items = []
+            if "responseItems" in query_result:
+                for response_item in query_result["responseItems"]:
+                    # Keep only the fields the monthly report reads
+                    item = response_item.get("item")
+                    if item is not None:
+                        items.append((item.get("date", ""), item.get("flex_credits_used"),
+                                      item.get("prompts_used")))
+            results.append(items)
+    
+    failures = []
+    if 1 < len(api_keys) != len(results):
+        # The server did not answer every query in the batch; ask per key
+        results = []
+        for api_key in api_keys:
+            _, key_results, key_failures = fetch_data_for_api_keys([api_key], start_date, end_date)
+            results.extend(key_results)
+            failures.extend(key_failures)
+    
+    return api_keys, results, failures
+
+
+def fetch_parallel(api_keys, start_date, end_date, max_workers=20, batch_size=10):
+    """Fetch data in parallel for multiple API keys, batch_size keys per request"""
     all_items = []
     active_users = 0
-    
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(fetch_data_for_api_key, key, start_date, end_date): key 
-                   for key in api_keys}
+    failures = []
+    batches = [api_keys[i:i + batch_size] for i in range(0, len(api_keys), batch_size)]
+    # Requests are blocking I/O that releases the GIL, so threads are enough
+    workers = size_workers(max_workers, len(batches))
+    print(f"⚡ Using {workers} workers\n")
+    if batches:
+        check_gzip_support(build_payload_body(create_payload, batches[0][:1], start_date, end_date))
+    
+    futures = {analytics_client.executor.submit(fetch_data_for_api_keys, batch, start_date, end_date): batch
+               for batch in batches}
+    
+    processed = 0
+    refresh_every = max(1, len(futures) // 100)
+    
+    with tqdm(total=len(api_keys), desc="📊 Processing users", 
+              unit="user", bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}{postfix}]',
+              mininterval=0.5) as pbar:
         
-        with tqdm(total=len(api_keys), desc="📊 Processing users", 
-                  unit="user", bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]') as pbar:
+        for completed, future in enumerate(as_completed(futures), 1):
+            batch, results, batch_failures = future.result()
+            failures.extend(batch_failures)
             
-            for future in as_completed(futures):
-                api_key, items = future.result()
-                
+            for items in results:
                 if items:
                     all_items.extend(items)
                     active_users += 1
-                    pbar.set_postfix({'active': active_users, 'data_points': len(all_items)})
-                
-                pbar.update(1)
+            
+            # Touch the bar only about once per percent of the batches; every
+            # tqdm call takes its lock and may repaint the line
+            processed += len(batch)
+            if completed % refresh_every == 0 or completed == len(futures):
+                pbar.set_postfix({'workers': workers, 'active': active_users, 'data_points': len(all_items)}, refresh=False)
+                pbar.update(processed - pbar.n)
     
     print(f"\n✅ Complete! Processed {len(api_keys)} users | Active: {active_users} | Data points: {len(all_items)}\n")
     
+    if failures:
+        report_failures(failures)
+    
     return all_items
 
 
-def safe_float(value):
-    """Safely convert value to float, handling None, '<nil>', empty strings, etc."""
-    if value is None or value == '' or value == '<nil>':
-        return 0.0
-    try:
-        return float(value)
-    except (ValueError, TypeError):
-        return 0.0
-
-
 def aggregate_by_month(items):
-    """Aggregate items by month (YYYY-MM format)"""
-    monthly_data = defaultdict(lambda: {
-        "total_flex_credits": 0,
-        "total_prompt_credits": 0,
-        "total_credits_used": 0,
-        "data_points": 0
-    })
-    
-    for item in items:
-        date = item.get("date", "")
-        if not date:
-            continue
-        
-        # Extract month (YYYY-MM) from date (YYYY-MM-DD)
-        month = date[:7]
+    """Aggregate (date, flex_credits_used, prompts_used) tuples by month (YYYY-MM format)"""
+    if pd is not None:
+        # Vectorized groupby-sum; the per-item loop below is the fallback
+        df = pd.DataFrame(items, columns=['date', 'flex_credits_used', 'prompts_used'])
+        df = df[df['date'].fillna('').astype(bool)]
         
-        flex_credits = safe_float(item.get("flex_credits_used")) / 100
-        prompt_credits = safe_float(item.get("prompts_used")) / 100
+        # Extract month (YYYY-MM) from date (YYYY-MM-DD); credits are in hundredths
+        df = df.assign(
+            month=df['date'].str.slice(0, 7),
+            flex=pd.to_numeric(df['flex_credits_used'], errors='coerce').fillna(0) / 100,
+            prompts=pd.to_numeric(df['prompts_used'], errors='coerce').fillna(0) / 100
+        )
+        grouped = df.groupby('month', sort=False).agg(
+            total_flex_credits=('flex', 'sum'),
+            total_prompt_credits=('prompts', 'sum'),
+            data_points=('date', 'size')
+        )
+        grouped['total_credits_used'] = grouped['total_flex_credits'] + grouped['total_prompt_credits']
         
-        monthly_data[month]["total_flex_credits"] += flex_credits
-        monthly_data[month]["total_prompt_credits"] += prompt_credits
-        monthly_data[month]["total_credits_used"] += (flex_credits + prompt_credits)
-        monthly_data[month]["data_points"] += 1
+        return grouped[['total_flex_credits', 'total_prompt_credits',
+                        'total_credits_used', 'data_points']].to_dict('index')
+    
+    # Kept in a stdlib-only module so PyPy's JIT can run it without pandas
+    try:
+        from .monthly_core import sum_items_by_month
+    except ImportError:
+        from monthly_core import sum_items_by_month
     
-    return monthly_data
+    return sum_items_by_month(items)
 
 
 def format_month_for_display(month_str):
     """Format month as 'September 2025'"""
     try:
-        dt = datetime.strptime(month_str + "-01", "%Y-%m-%d")
-        return dt.strftime("%B %Y")
-    except:
+        month = int(month_str[5:7])
+    except ValueError:
+        return month_str
+    
+    if not 1 <= month <= 12:
         return month_str
+    
+    return f"{MONTH_NAMES[month - 1]} {month_str[:4]}"
 
 
 def save_results(monthly_data, start_date, end_date):
@@ -263,23 +353,41 @@ def save_results(monthly_data, start_date, end_date):
     
     csv_filename = os.path.join(OUTPUT_DIR, f"team_monthly_credits_{period_str}_{current_date}.csv")
     
-    with open(csv_filename, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=[
+    # Build the CSV rows and the console table and add up the totals in a
+    # single pass over the months
+    csv_rows = []
+    table_lines = []
+    grand_total_flex = 0
+    grand_total_prompt = 0
+    grand_total_credits = 0
+    grand_total_points = 0
+    months_with_flex = 0
+    
+    for month in sorted_months:
+        data = monthly_data[month]
+        month_formatted = format_month_for_display(month)
+        flex = data['total_flex_credits']
+        prompt = data['total_prompt_credits']
+        total = data['total_credits_used']
+        points = data['data_points']
+        
+        csv_rows.append((month, month_formatted, f"{flex:.2f}", f"{prompt:.2f}", f"{total:.2f}", points))
+        table_lines.append(f"{month_formatted:<20} {flex:>18,.2f} {prompt:>18,.2f} {total:>18,.2f} {points:>15,}")
+        
+        grand_total_flex += flex
+        grand_total_prompt += prompt
+        grand_total_credits += total
+        grand_total_points += points
+        if flex > 0:
+            months_with_flex += 1
+    
+    with open(csv_filename, 'w', newline='', buffering=1 << 20) as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([
             'month', 'month_formatted', 'total_flex_credits', 
             'total_prompt_credits', 'total_credits_used', 'data_points'
         ])
-        writer.writeheader()
-        
-        for month in sorted_months:
-            data = monthly_data[month]
-            writer.writerow({
-                'month': month,
-                'month_formatted': format_month_for_display(month),
-                'total_flex_credits': f"{data['total_flex_credits']:.2f}",
-                'total_prompt_credits': f"{data['total_prompt_credits']:.2f}",
-                'total_credits_used': f"{data['total_credits_used']:.2f}",
-                'data_points': data['data_points']
-            })
+        writer.writerows(csv_rows)
     
     print(f"✅ Report saved: {csv_filename}\n")
     
@@ -287,26 +395,11 @@ def save_results(monthly_data, start_date, end_date):
     print("=" * 120)
     print(f"TEAM MONTHLY CREDITS SUMMARY")
     print("=" * 120)
-    print(f"Period: {format_month_for_display(sorted_months[0])} to {format_month_for_display(sorted_months[-1])}")
+    print(f"Period: {csv_rows[0][1]} to {csv_rows[-1][1]}")
     print("=" * 120)
     print(f"\n{'Month':<20} {'Flex Credits':>18} {'Prompt Credits':>18} {'Total Credits':>18} {'Data Points':>15}")
     print("-" * 120)
-    
-    grand_total_flex = 0
-    grand_total_prompt = 0
-    grand_total_credits = 0
-    grand_total_points = 0
-    
-    for month in sorted_months:
-        data = monthly_data[month]
-        month_formatted = format_month_for_display(month)
-        print(f"{month_formatted:<20} {data['total_flex_credits']:>18,.2f} {data['total_prompt_credits']:>18,.2f} {data['total_credits_used']:>18,.2f} {data['data_points']:>15,}")
-        
-        grand_total_flex += data['total_flex_credits']
-        grand_total_prompt += data['total_prompt_credits']
-        grand_total_credits += data['total_credits_used']
-        grand_total_points += data['data_points']
-    
+    print("\n".join(table_lines))
     print("-" * 120)
     print(f"{'TOTAL':<20} {grand_total_flex:>18,.2f} {grand_total_prompt:>18,.2f} {grand_total_credits:>18,.2f} {grand_total_points:>15,}")
     print("=" * 120)
@@ -319,9 +412,8 @@ def save_results(monthly_data, start_date, end_date):
     if len(sorted_months) > 0:
         print(f"   - Average credits per month: {grand_total_credits / len(sorted_months):,.2f}")
     
-    months_with_flex = [m for m in sorted_months if monthly_data[m]['total_flex_credits'] > 0]
     if months_with_flex:
-        print(f"\n⚠️  Months with flex credits: {len(months_with_flex)} of {len(sorted_months)}")
+        print(f"\n⚠️  Months with flex credits: {months_with_flex} of {len(sorted_months)}")
     else:
         print(f"\n✅ No flex credits used in any month")
 
@@ -340,10 +432,15 @@ def main():
     parser.add_argument('--start-date', type=str, help='Start date YYYY-MM-DD')
     parser.add_argument('--end-date', type=str, help='End date YYYY-MM-DD')
     parser.add_argument('--workers', type=int, default=20, help='Parallel workers (default: 20)')
+    parser.add_argument('--batch-size', type=int, default=10, help='API keys per request (default: 10)')
     parser.add_argument('--json-file', type=str, help='Custom email mapping file')
     
     args = parser.parse_args()
     
+    if args.batch_size < 1:
+        print("Error: Batch size must be ≥ 1")
+        return
+    
     # Determine date range
     if args.start_date and args.end_date:
         start_date = parse_date(args.start_date)
@@ -364,7 +461,12 @@ def main():
     print(f"TEAM MONTHLY CREDITS SUMMARY")
     print(f"{'='*120}")
     print(f"Date range: {start_date} to {end_date}")
-    print(f"Parallel workers: {args.workers}\n")
+    print(f"Parallel workers: {args.workers}")
+    print(f"Batch size: {args.batch_size} API keys per request\n")
+    
+    # Size the connection pool before the email mapping request so its
+    # keep-alive connection is still there for the fetch
+    size_connection_pool(args.workers)
     
     # Load API keys
     json_file = args.json_file or find_latest_email_mapping_file()
@@ -388,8 +490,7 @@ def main():
     
     # Fetch data in parallel
     print("🚀 Starting parallel data fetch...")
-    print(f"⚡ Using {args.workers} workers for maximum speed\n")
-    items = fetch_parallel(api_keys, start_date, end_date, args.workers)
+    items = fetch_parallel(api_keys, start_date, end_date, args.workers, args.batch_size)
     
     if not items:
         print("❌ No data retrieved")